@@ -1,6 +1,19 @@
-from collections import UserDict
+import gc
+import lzma
+import os
+import struct
+import sys
+import time
+import tracemalloc
+import zlib
+from collections import UserDict, deque
+from collections.abc import MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from datetime import datetime
-from pickle import dump, load
+from itertools import islice
+from pickle import dumps, load, loads
+from weakref import WeakValueDictionary
 
 
 class Connection:
@@ -16,6 +29,303 @@ class Connection:
         print('Connection: data saved')
 
 
+class ChangeFeed:
+    def __init__(self, maxlen=0):
+        self.seq = 0
+        self.log = deque(maxlen=maxlen)
+        self.subscribers = []
+        self.muted = False
+
+    @property
+    def active(self):
+        # maxlen=None keeps an unbounded history
+        return bool(self.subscribers) or self.log.maxlen != 0
+
+    def set_history(self, maxlen):
+        self.log = deque(self.log, maxlen=maxlen)
+
+    def publish(self, op, name, *args):
+        if self.muted:
+            return None
+        self.seq += 1
+        entry = (self.seq, op, name, args)
+        self.log.append(entry)
+        for callback in self.subscribers:
+            callback(entry)
+        return entry
+
+    def since(self, seq):
+        return [entry for entry in self.log if entry[0] > seq]
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        if callback in self.subscribers:
+            self.subscribers.remove(callback)
+
+
+class ReplicationError(ValueError):
+    pass
+
+
+class LogShipper:
+    MAGIC = b'PBLG'
+    HEADER = struct.Struct('>4s16s')
+    FRAME = struct.Struct('>II')
+
+    def __init__(self, path):
+        self.path = path
+        self.log_id = os.urandom(16)
+        self.fd = open(path, 'wb')
+        self.fd.write(self.HEADER.pack(self.MAGIC, self.log_id))
+        self.fd.flush()
+
+    def __call__(self, entry):
+        payload = dumps(entry)
+        self.fd.write(self.FRAME.pack(len(payload), zlib.crc32(payload)))
+        self.fd.write(payload)
+        self.fd.flush()
+
+    def close(self):
+        self.fd.close()
+
+
+class Replica:
+    def __init__(self, path, book=None):
+        self.path = path
+        self.book = book if book is not None else AddressBook()
+        self.log_id = None
+        self.offset = 0
+        self.seq = None
+
+    def poll(self):
+        if not os.path.exists(self.path):
+            return 0
+        applied = 0
+        with open(self.path, 'rb') as fd:
+            raw = fd.read(LogShipper.HEADER.size)
+            if len(raw) < LogShipper.HEADER.size:
+                # the primary is still creating the log
+                return 0
+            magic, log_id = LogShipper.HEADER.unpack(raw)
+            if magic != LogShipper.MAGIC:
+                raise ReplicationError(f'{self.path} is not a change log')
+            if log_id != self.log_id:
+                # the primary started shipping a new log
+                self.log_id = log_id
+                self.offset = fd.tell()
+                self.seq = None
+            fd.seek(self.offset)
+            while True:
+                entry = self._read_entry(fd)
+                if entry is None:
+                    break
+                self._apply(entry)
+                self.offset = fd.tell()
+                applied += 1
+        return applied
+
+    def _read_entry(self, fd):
+        start = fd.tell()
+        raw = fd.read(LogShipper.FRAME.size)
+        if len(raw) < LogShipper.FRAME.size:
+            return None
+        size, checksum = LogShipper.FRAME.unpack(raw)
+        payload = fd.read(size)
+        if len(payload) < size:
+            # the entry is still being written
+            return None
+        if zlib.crc32(payload) != checksum:
+            raise ReplicationError(f'Corrupt log entry at offset {start}')
+        try:
+            return loads(payload)
+        except Exception as exc:
+            raise ReplicationError(
+                f'Undecodable log entry at offset {start}') from exc
+
+    def tail(self, interval=1.0):
+        while True:
+            yield self.poll()
+            time.sleep(interval)
+
+    def _apply(self, entry):
+        seq, op, name, args = entry
+        if self.seq is None:
+            if op != 'snapshot':
+                raise ReplicationError('Change log must start with a snapshot')
+        elif seq != self.seq + 1:
+            raise ReplicationError(f'Expected entry {self.seq + 1}, got {seq}')
+        if op == 'batch':
+            for change in args[0]:
+                self._apply_change(*change)
+        else:
+            self._apply_change(op, name, args)
+        self.seq = seq
+
+    def _apply_change(self, op, name, args):
+        data = self.book.data
+        if op == 'snapshot':
+            self.book.data = self.book._restore(loads(args[0]).items())
+        elif op == 'add_record':
+            data[name] = loads(args[0])
+        elif op == 'delete':
+            data.pop(name, None)
+        else:
+            getattr(data[name], op)(*args)
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class Snapshot:
+    MAGIC = b'PBAB'
+    # version 2 chunks may hold records that are already pickled
+    VERSION = 2
+    HEADER = struct.Struct('>4sBBI')
+    CHUNK = struct.Struct('>II')
+    CODECS = {'zlib': (0, zlib.compress, zlib.decompress),
+              'lzma': (1, lzma.compress, lzma.decompress)}
+
+    def __init__(self, path, chunk_size=1000, codec='zlib', workers=None):
+        if codec not in self.CODECS:
+            raise ValueError(f'Unknown codec: {codec}')
+        if chunk_size < 1:
+            raise ValueError('chunk_size should be greater than 0')
+        self.path = path
+        self.chunk_size = chunk_size
+        self.codec = codec
+        self.workers = workers
+
+    def save(self, items):
+        items = iter(items)
+        chunks = iter(lambda: list(islice(items, self.chunk_size)), [])
+        window = 2 * (self.workers or os.cpu_count() or 1)
+        codec_id = self.CODECS[self.codec][0]
+        tmp_path = self.path + '.tmp'
+        try:
+            with ThreadPoolExecutor(self.workers) as pool, \
+                    open(tmp_path, 'wb') as fd:
+                # the chunk count is patched in once every chunk is written
+                fd.write(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                          codec_id, 0))
+                count = 0
+                pending = deque()
+                for chunk in chunks:
+                    pending.append(pool.submit(self._encode, chunk))
+                    if len(pending) >= window:
+                        self._write_chunk(fd, pending.popleft().result())
+                        count += 1
+                while pending:
+                    self._write_chunk(fd, pending.popleft().result())
+                    count += 1
+                fd.seek(0)
+                fd.write(self.HEADER.pack(self.MAGIC, self.VERSION,
+                                          codec_id, count))
+                fd.flush()
+                os.fsync(fd.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def load(self):
+        with open(self.path, 'rb') as fd:
+            count = self._read_header(fd)
+            if count is None:
+                return self._load_legacy(fd)
+            payloads = [self._read_chunk(fd, i) for i in range(count)]
+        data = dict()
+        # only decompression runs in parallel, unpickling holds the GIL
+        with ThreadPoolExecutor(self.workers) as pool, self._gc_paused():
+            for raw in pool.map(self._decompress, payloads):
+                for name, record in loads(raw):
+                    if isinstance(record, bytes):
+                        record = loads(record)
+                    data[name] = record
+        return data
+
+    def __iter__(self):
+        for name, record in self.iter_raw():
+            if isinstance(record, bytes):
+                record = loads(record)
+            yield name, record
+
+    def iter_raw(self):
+        with open(self.path, 'rb') as fd:
+            count = self._read_header(fd)
+            if count is None:
+                yield from self._load_legacy(fd).items()
+                return
+            for i in range(count):
+                yield from self._decode(self._read_chunk(fd, i))
+
+    @staticmethod
+    @contextmanager
+    def _gc_paused():
+        # unpickling creates many tracked objects, and the collections
+        # they trigger cost more than the unpickling itself
+        enabled = gc.isenabled()
+        gc.disable()
+        try:
+            yield
+        finally:
+            if enabled:
+                gc.enable()
+
+    def _read_header(self, fd):
+        raw = fd.read(self.HEADER.size)
+        if not raw.startswith(self.MAGIC):
+            fd.seek(0)
+            return None
+        if len(raw) < self.HEADER.size:
+            raise SnapshotError('Snapshot header is truncated')
+        magic, version, codec_id, count = self.HEADER.unpack(raw)
+        if not 1 <= version <= self.VERSION:
+            raise SnapshotError(f'Unsupported snapshot version: {version}')
+        for name, (known_id, _, _) in self.CODECS.items():
+            if known_id == codec_id:
+                self.codec = name
+                return count
+        raise SnapshotError(f'Unknown snapshot codec: {codec_id}')
+
+    def _read_chunk(self, fd, index):
+        raw = fd.read(self.CHUNK.size)
+        if len(raw) < self.CHUNK.size:
+            raise SnapshotError(f'Chunk {index} is truncated')
+        size, checksum = self.CHUNK.unpack(raw)
+        payload = fd.read(size)
+        if len(payload) < size or zlib.crc32(payload) != checksum:
+            raise SnapshotError(f'Chunk {index} is corrupt')
+        return payload
+
+    def _write_chunk(self, fd, payload):
+        fd.write(self.CHUNK.pack(len(payload), zlib.crc32(payload)))
+        fd.write(payload)
+
+    def _load_legacy(self, fd):
+        if not fd.read(1):
+            return dict()
+        fd.seek(0)
+        try:
+            with self._gc_paused():
+                return load(fd)
+        except Exception as exc:
+            raise SnapshotError('Snapshot is corrupt') from exc
+
+    def _encode(self, chunk):
+        return self.CODECS[self.codec][1](dumps(chunk))
+
+    def _decompress(self, payload):
+        return self.CODECS[self.codec][2](payload)
+
+    def _decode(self, payload):
+        with self._gc_paused():
+            return loads(self._decompress(payload))
+
+
 class Field:
     def __init__(self, value):
         if self.validate(value):
@@ -60,37 +370,50 @@ class Phone(Field):
 
 
 class Record:
+    _feed = None
+
     def __init__(self, name, *phones, birthday=None):
         self.name = Name(name)
         self.phones = [Phone(i) for i in phones] if phones else []
         self.birthday = Birthday(birthday)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state.pop('_feed', None)
+        return state
+
+    def _publish(self, op, *args):
+        if self._feed is not None:
+            self._feed.publish(op, self.name.value, *args)
+
     def add_phone(self, phone):
         if phone not in map(lambda x: x.value, self.phones):
             self.phones.append(Phone(phone))
+            self._publish('add_phone', phone)
 
     def remove_phone(self, phone):
         for el in self.phones:
             if el.value == phone:
                 self.phones.remove(el)
+                self._publish('remove_phone', phone)
 
     def edit_phone(self, old, new):
-        temp = {p.value: p for p in self.phones}
-        if old in temp.keys():
-            old_ind = self.phones.index(temp[old])
-            self.phones[old_ind].value = new
-        else:
+        found = self.find_phone(old)
+        if found is None:
             raise ValueError('No such phone number')
+        found.value = new
+        self._publish('edit_phone', old, new)
 
     def find_phone(self, phone):
-        temp = {p.value: p for p in self.phones}
-        if phone in temp.keys():
-            return temp[phone]
+        for p in self.phones:
+            if p.value == phone:
+                return p
         return None
 
     def add_birthday(self, birthday):
         if self.birthday.value is None:
             self.birthday.value = birthday
+            self._publish('add_birthday', birthday)
         else:
             raise ValueError('Birthday is already set')
 
@@ -118,9 +441,177 @@ class Record:
                f"birthday: {self.birthday.value}."
 
 
+class RecordStore(MutableMapping):
+    # Records in the store publish through it, so edits re-measure hot
+    # records and re-pickle evicted ones that are still referenced.
+    # Evicted records stay reachable through weak references while anyone
+    # holds them. Assigning Field.value directly on a record that was
+    # evicted and then dropped is not tracked, just as it is not published
+    # to the change feed.
+    POINTER = struct.calcsize('P')
+
+    def __init__(self, budget, feed=None, data=()):
+        self.budget = budget
+        self.feed = feed
+        self.entries = dict()
+        # names of hot records in access order, mapped to their size
+        self.lru = dict()
+        self.hot_size = 0
+        # pickled form of hot records that have not changed since loading
+        self.clean = dict()
+        self.live = WeakValueDictionary()
+        self.update(data)
+
+    @classmethod
+    def field_sizeof(cls, field):
+        # attributes are counted as pointers, vars() would allocate a dict
+        return (sys.getsizeof(field) + cls.POINTER
+                + sys.getsizeof(field.value))
+
+    @classmethod
+    def footprint(cls, record):
+        return {
+            'records': sys.getsizeof(record) + 4 * cls.POINTER,
+            'fields': (cls.field_sizeof(record.name)
+                       + cls.field_sizeof(record.birthday)),
+            'phones': (sys.getsizeof(record.phones)
+                       + sum(cls.field_sizeof(p) for p in record.phones)),
+        }
+
+    @classmethod
+    def sizeof(cls, record):
+        # same total as footprint() without building the breakdown
+        size = (sys.getsizeof(record) + 4 * cls.POINTER
+                + sys.getsizeof(record.phones))
+        for field in (record.name, record.birthday, *record.phones):
+            size += (sys.getsizeof(field) + cls.POINTER
+                     + sys.getsizeof(field.value))
+        return size
+
+    def __getitem__(self, name):
+        record = self.entries[name]
+        if isinstance(record, bytes):
+            self.clean[name] = record
+            record = self.live.pop(name, None) or loads(record)
+            record._feed = self
+            self.entries[name] = record
+            self._track(name, record)
+            self._shrink()
+        else:
+            self.lru[name] = self.lru.pop(name)
+        return record
+
+    def __setitem__(self, name, record):
+        self._forget(name)
+        self.entries[name] = record
+        if not isinstance(record, bytes):
+            record._feed = self
+            self._track(name, record)
+            self._shrink()
+
+    def __delitem__(self, name):
+        del self.entries[name]
+        self._forget(name)
+
+    def __contains__(self, name):
+        return name in self.entries
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def raw_items(self):
+        for name, record in self.entries.items():
+            yield name, self.clean.get(name, record)
+
+    def changed(self, name):
+        record = self.entries.get(name)
+        if isinstance(record, bytes):
+            held = self.live.get(name)
+            if held is not None:
+                self.entries[name] = dumps(held)
+        elif record is not None:
+            self.clean.pop(name, None)
+            self._untrack(name)
+            self._track(name, record)
+            self._shrink()
+
+    def publish(self, op, name, *args):
+        self.changed(name)
+        if self.feed is not None:
+            return self.feed.publish(op, name, *args)
+        return None
+
+    def detach(self):
+        for record in self.entries.values():
+            if not isinstance(record, bytes):
+                record._feed = None
+        for record in self.live.values():
+            record._feed = None
+        self.feed = None
+
+    def _track(self, name, record):
+        size = self.sizeof(record)
+        if name in self.clean:
+            size += sys.getsizeof(self.clean[name])
+        self.lru[name] = size
+        self.hot_size += size
+
+    def _untrack(self, name):
+        if name in self.lru:
+            self.hot_size -= self.lru.pop(name)
+
+    def _forget(self, name):
+        self._untrack(name)
+        self.clean.pop(name, None)
+        self.live.pop(name, None)
+
+    def _shrink(self):
+        # the most recently used record always stays hot
+        while self.hot_size > self.budget and len(self.lru) > 1:
+            name = next(iter(self.lru))
+            self.hot_size -= self.lru.pop(name)
+            record = self.entries[name]
+            raw = self.clean.pop(name, None)
+            self.entries[name] = raw if raw is not None else dumps(record)
+            self.live[name] = record
+
+
 class AddressBook(UserDict):
+    path = 'data.bin'
+    chunk_size = 1000
+    codec = 'zlib'
+    trace_memory = False
+
+    def __init__(self, *args, memory_budget=None, history=0, **kwargs):
+        self.feed = ChangeFeed(history)
+        self.shipper = None
+        self.memory_budget = memory_budget
+        self.load_peak = None
+        super().__init__(*args, **kwargs)
+        self.data = self._restore(self.data.items())
+
     def add_record(self, user):
+        old = self.data.get(user.name.value)
+        if old is not None and old is not user:
+            old._feed = None
+        # a RecordStore replaces the feed with itself
+        user._feed = self.feed
         self.data[user.name.value] = user
+        self.feed.publish('add_record', user.name.value,
+                          dumps(user) if self.feed.active else None)
+
+    def __setitem__(self, name, user):
+        if name != user.name.value:
+            raise ValueError('Key should match the contact name')
+        self.add_record(user)
+
+    def __delitem__(self, name):
+        if name not in self.data:
+            raise KeyError(name)
+        self.delete(name)
 
     def find(self, name):
         return self.data.get(name)
@@ -139,32 +630,213 @@ class AddressBook(UserDict):
             raise ValueError('Wrong input format')
 
     def delete(self, name):
-        if self.data.get(name) is not None:
+        record = self.data.get(name)
+        if record is not None:
             del self.data[name]
+            record._feed = None
+            self.feed.publish('delete', name)
+
+    @contextmanager
+    def batch(self):
+        ops = []
+        yield ops
+        self.apply_changes(ops)
+
+    def apply_changes(self, ops):
+        pending = {}
+        structure = []
+        undo = []
+        touched = {}
+        changes = []
+        applied = 0
+        active = self.feed.active
+
+        def current(name):
+            if name in pending:
+                return pending[name]
+            return self.data.get(name)
+
+        self.feed.muted = True
+        try:
+            for change in ops:
+                op, name, params = change[0], change[1], change[2:]
+                if op == 'add_record':
+                    user = name
+                    name = user.name.value
+                    pending[name] = user
+                    structure.append((op, name, user))
+                    params = (dumps(user) if active else None,)
+                elif op == 'delete':
+                    if current(name) is None:
+                        continue
+                    pending[name] = None
+                    structure.append((op, name, None))
+                elif op in ('add_phone', 'remove_phone',
+                            'edit_phone', 'add_birthday'):
+                    record = current(name)
+                    if record is None:
+                        raise ValueError(f'No such contact: {name}')
+                    touched[name] = record
+                    if isinstance(self.data, RecordStore):
+                        # edits below may not publish, drop the clean copy
+                        self.data.changed(name)
+                    if op == 'edit_phone':
+                        # same checks as Record.edit_phone without the
+                        # second scan and the per-op publish
+                        phone = record.find_phone(params[0])
+                        if phone is None:
+                            raise ValueError('No such phone number')
+                        phone.value = params[1]
+                        undo.append((phone, 'value', params[0]))
+                    elif op == 'add_birthday':
+                        record.add_birthday(*params)
+                        undo.append((record.birthday, 'value', None))
+                    else:
+                        undo.append((record, 'phones', record.phones[:]))
+                        getattr(record, op)(*params)
+                else:
+                    raise ValueError(f'Unknown operation: {op}')
+                applied += 1
+                if active:
+                    changes.append((op, name, params))
+        except Exception:
+            for obj, attr, value in reversed(undo):
+                setattr(obj, attr, value)
+            if isinstance(self.data, RecordStore):
+                # records evicted mid-batch were pickled with the edits;
+                # touched keeps them alive so refresh can find them
+                for name in touched:
+                    self.data.changed(name)
+            raise
+        finally:
+            self.feed.muted = False
+
+        for op, name, user in structure:
+            old = self.data.pop(name, None) if op == 'delete' \
+                else self.data.get(name)
+            if old is not None and old is not user:
+                old._feed = None
+            if user is not None:
+                user._feed = self.feed
+                self.data[name] = user
+        if applied:
+            self.feed.publish('batch', None, changes)
+        return applied
 
     def iterator(self, n):
         if n == 0:
             raise ValueError('n should be greater than 0')
 
-        start = 0
-        step = n
-        end = len(self.data)
-        while start < end:
-            temp = list(self.data.values())[start:step]
-            yield [str(i) for i in temp]
-            start += n
-            step += n
+        page = []
+        for record in self.data.values():
+            page.append(str(record))
+            if len(page) == n:
+                yield page
+                page = []
+        if page:
+            yield page
+
+    def memory_report(self):
+        data = self.data
+        report = dict.fromkeys(('records', 'fields', 'phones', 'cold'), 0)
+        report['index'] = 0
+        if isinstance(data, RecordStore):
+            # clean copies of hot records count as pickled data
+            report['cold'] = sum(sys.getsizeof(r) for r in data.clean.values())
+            report['index'] = (sys.getsizeof(data.lru)
+                               + sys.getsizeof(data.clean))
+            data = data.entries
+        report['index'] += sys.getsizeof(data)
+        report['feed'] = sys.getsizeof(self.feed.log) + sum(
+            sys.getsizeof(entry) + sum(sys.getsizeof(a) for a in entry[3])
+            for entry in self.feed.log)
+        formatted = 0
+        for record in data.values():
+            if isinstance(record, bytes):
+                report['cold'] += sys.getsizeof(record)
+                continue
+            for component, size in RecordStore.footprint(record).items():
+                report[component] += size
+            formatted += sys.getsizeof(str(record))
+        report['total'] = sum(report.values())
+        report['contacts'] = len(data)
+        report['per_contact'] = report['total'] // max(len(data), 1)
+        # transient costs, not part of the resident total
+        report['formatted'] = formatted
+        report['load_peak'] = self.load_peak
+        return report
+
+    def ship_log(self, path):
+        self.stop_shipping()
+        self.shipper = LogShipper(path)
+        self.feed.subscribe(self.shipper)
+        self._publish_snapshot()
+
+    def stop_shipping(self):
+        if self.shipper is not None:
+            self.feed.unsubscribe(self.shipper)
+            self.shipper.close()
+            self.shipper = None
+
+    def _publish_snapshot(self):
+        self.feed.publish('snapshot', None, dumps(dict(self._raw_items())))
+
+    def _detach(self):
+        if isinstance(self.data, RecordStore):
+            self.data.detach()
+            return
+        for record in self.data.values():
+            record._feed = None
+
+    def _raw_items(self):
+        if isinstance(self.data, RecordStore):
+            return self.data.raw_items()
+        return self.data.items()
+
+    def _restore(self, items):
+        if self.memory_budget is None:
+            return {name: loads(record) if isinstance(record, bytes)
+                    else record for name, record in items}
+        return RecordStore(self.memory_budget, self.feed, items)
+
+    def _snapshot(self):
+        return Snapshot(self.path, self.chunk_size, self.codec)
 
     def _save_data(self):
-        with open('data.bin', 'wb') as fd:
-            dump(self.data, fd)
+        self._snapshot().save(self._raw_items())
 
     def _load_data(self):
+        started = self.trace_memory and not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
         try:
-            with open('data.bin', 'rb') as fd:
-                self.data = load(fd)
-        except Exception:
-            self.data = dict()
+            if tracemalloc.is_tracing():
+                tracemalloc.reset_peak()
+                before = tracemalloc.get_traced_memory()[0]
+            try:
+                if self.memory_budget is None:
+                    data = self._snapshot().load()
+                else:
+                    # stream chunks into the store so cold records stay
+                    # pickled instead of the whole book being unpickled
+                    data = self._restore(self._snapshot().iter_raw())
+            except FileNotFoundError:
+                data = self._restore(())
+            if tracemalloc.is_tracing():
+                self.load_peak = tracemalloc.get_traced_memory()[1] - before
+        finally:
+            if started:
+                tracemalloc.stop()
+        # records still held from before the reload must not publish
+        # under names that now belong to the reloaded records
+        self._detach()
+        self.data = data
+        if not isinstance(self.data, RecordStore):
+            for record in self.data.values():
+                record._feed = self.feed
+        if self.shipper is not None:
+            self._publish_snapshot()
+
 
 if __name__ == '__main__':
     # Створення нової адресної книги
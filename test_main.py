@@ -0,0 +1,456 @@
+import os
+import pickle
+import tempfile
+import tracemalloc
+import unittest
+
+import main
+
+
+class TempDirTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+
+class TestChangeFeed(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.book = main.AddressBook()
+        self.entries = []
+        self.book.feed.subscribe(self.entries.append)
+
+    def test_seq_numbers(self):
+        john = main.Record('John', '1234567890')
+        self.book.add_record(john)
+        john.add_phone('5555555555')
+        john.edit_phone('1234567890', '4444444444')
+        john.remove_phone('5555555555')
+        john.add_birthday('01.01.2000')
+        self.book.delete('John')
+        self.assertEqual([e[0] for e in self.entries], [1, 2, 3, 4, 5, 6])
+        self.assertEqual([e[1] for e in self.entries],
+                         ['add_record', 'add_phone', 'edit_phone',
+                          'remove_phone', 'add_birthday', 'delete'])
+        self.assertEqual(self.book.feed.seq, 6)
+
+    def test_history_is_opt_in(self):
+        book = main.AddressBook()
+        john = main.Record('John', '1234567890')
+        book.add_record(john)
+        self.assertEqual(book.feed.since(0), [])
+        self.assertFalse(book.feed.active)
+        book.feed.set_history(10)
+        john.add_phone('5555555555')
+        self.assertEqual([e[:3] for e in book.feed.since(0)],
+                         [(2, 'add_phone', 'John')])
+
+    def test_unbounded_history(self):
+        book = main.AddressBook(history=None)
+        self.assertTrue(book.feed.active)
+        book.add_record(main.Record('John', '1234567890'))
+        payload = book.feed.since(0)[0][3][0]
+        self.assertEqual(str(pickle.loads(payload)),
+                         'Contact name: John; phones: 1234567890.')
+
+    def test_mapping_mutators_publish(self):
+        ann = main.Record('Ann', '1111111111')
+        self.book['Ann'] = ann
+        with self.assertRaises(ValueError):
+            self.book['Bob'] = main.Record('Ann', '2222222222')
+        del self.book['Ann']
+        ann.add_phone('2222222222')
+        with self.assertRaises(KeyError):
+            del self.book['Ann']
+        self.book.update(Bob=main.Record('Bob', '3333333333'))
+        self.book.pop('Bob')
+        self.book['Cid'] = main.Record('Cid', '4444444444')
+        self.book.clear()
+        self.assertEqual([e[1:3] for e in self.entries],
+                         [('add_record', 'Ann'), ('delete', 'Ann'),
+                          ('add_record', 'Bob'), ('delete', 'Bob'),
+                          ('add_record', 'Cid'), ('delete', 'Cid')])
+
+    def test_deleted_record_is_detached(self):
+        jane = main.Record('Jane', '1111111111')
+        self.book.add_record(jane)
+        self.book.delete('Jane')
+        jane.add_phone('2222222222')
+        self.assertEqual(self.entries[-1][1], 'delete')
+
+    def test_replaced_record_is_detached(self):
+        old = main.Record('A', '1111111111')
+        self.book.add_record(old)
+        self.book.add_record(main.Record('A', '2222222222'))
+        old.add_phone('3333333333')
+        self.assertEqual(self.entries[-1][1], 'add_record')
+
+
+class TestReplica(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log = self.path('feed.log')
+        self.book = main.AddressBook()
+        self.book.add_record(main.Record('Old', '1111111111'))
+        self.book.ship_log(self.log)
+        self.addCleanup(self.book.stop_shipping)
+        self.replica = main.Replica(self.log)
+
+    def replica_view(self):
+        return sorted(str(r) for r in self.replica.book.data.values())
+
+    def primary_view(self):
+        return sorted(str(r) for r in self.book.data.values())
+
+    def test_catch_up(self):
+        self.assertEqual(self.replica.poll(), 1)
+        john = main.Record('John', '1234567890')
+        self.book.add_record(john)
+        john.add_phone('5555555555')
+        john.edit_phone('1234567890', '4444444444')
+        john.add_birthday('01.01.2000')
+        self.book.delete('Old')
+        self.assertEqual(self.replica.poll(), 5)
+        self.assertEqual(self.replica.poll(), 0)
+        self.assertEqual(self.replica.seq, self.book.feed.seq)
+        self.assertEqual(self.replica_view(), self.primary_view())
+
+    def test_partial_entry_waits(self):
+        self.book.add_record(main.Record('John', '1234567890'))
+        with open(self.log, 'rb') as fd:
+            raw = fd.read()
+        with open(self.log, 'wb') as fd:
+            fd.write(raw[:-3])
+        self.assertEqual(self.replica.poll(), 1)
+        with open(self.log, 'wb') as fd:
+            fd.write(raw)
+        self.assertEqual(self.replica.poll(), 1)
+        self.assertEqual(self.replica_view(), self.primary_view())
+
+    def test_new_log_is_detected(self):
+        self.replica.poll()
+        self.book.ship_log(self.log)
+        for i in range(20):
+            self.book.add_record(main.Record(f'Name{i}', f'{i:010d}'))
+        self.assertEqual(self.replica.poll(), 21)
+        self.assertEqual(self.replica_view(), self.primary_view())
+
+    def test_corrupt_entry_raises(self):
+        self.replica.poll()
+        self.book.add_record(main.Record('John', '1234567890'))
+        with open(self.log, 'r+b') as fd:
+            fd.seek(-2, os.SEEK_END)
+            fd.write(b'\xff\xff')
+        with self.assertRaises(main.ReplicationError):
+            self.replica.poll()
+
+    def test_gap_raises(self):
+        self.replica.poll()
+        self.book.feed.seq += 1
+        self.book.add_record(main.Record('John', '1234567890'))
+        with self.assertRaises(main.ReplicationError):
+            self.replica.poll()
+
+    def test_reload_detaches_old_records(self):
+        self.book.path = self.path('data.bin')
+        self.book.add_record(main.Record('John', '1234567890'))
+        self.book._save_data()
+        john = self.book.find('John')
+        self.book._load_data()
+        john.add_phone('5555555555')
+        self.replica.poll()
+        self.assertIsNot(self.book.find('John'), john)
+        self.assertEqual(self.replica_view(), self.primary_view())
+
+    def test_reload_detaches_old_records_with_budget(self):
+        book = main.AddressBook(memory_budget=1)
+        book.path = self.path('data.bin')
+        for name in ('John', 'Jane'):
+            book.add_record(main.Record(name, '1234567890'))
+        book._save_data()
+        john = book.find('John')
+        book.find('Jane')
+        entries = []
+        book.feed.subscribe(entries.append)
+        book._load_data()
+        john.add_phone('5555555555')
+        self.assertEqual(entries, [])
+
+    def test_failed_entry_is_retried(self):
+        self.book.add_record(main.Record('John', '1234567890'))
+        self.replica.poll()
+        offset, seq = self.replica.offset, self.replica.seq
+        del self.replica.book.data['John']
+        self.book.find('John').add_phone('5555555555')
+        with self.assertRaises(KeyError):
+            self.replica.poll()
+        self.assertEqual((self.replica.offset, self.replica.seq), (offset, seq))
+        self.replica.book.data['John'] = main.Record('John', '1234567890')
+        self.assertEqual(self.replica.poll(), 1)
+        self.assertEqual(self.replica_view(), self.primary_view())
+
+
+class TestBatch(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.book = main.AddressBook()
+        self.john = main.Record('John', '1234567890', '5555555555')
+        self.book.add_record(self.john)
+
+    def test_apply_changes(self):
+        jane = main.Record('Jane', '1111111111')
+        applied = self.book.apply_changes([
+            ('edit_phone', 'John', '1234567890', '4444444444'),
+            ('add_record', jane),
+            ('add_birthday', 'Jane', '01.01.2000'),
+            ('delete', 'Nobody'),
+        ])
+        self.assertEqual(applied, 3)
+        self.assertIs(self.book.find('John'), self.john)
+        self.assertIs(self.book.find('Jane'), jane)
+        self.assertEqual(str(self.john),
+                         'Contact name: John; phones: 4444444444, 5555555555.')
+        self.assertEqual(jane.birthday.value, '01.01.2000')
+
+    def test_rollback_when_later_op_fails(self):
+        seq = self.book.feed.seq
+        with self.assertRaises(ValueError):
+            self.book.apply_changes([
+                ('edit_phone', 'John', '1234567890', '4444444444'),
+                ('add_phone', 'John', '7777777777'),
+                ('remove_phone', 'John', '5555555555'),
+                ('add_birthday', 'John', '01.01.2000'),
+                ('add_record', main.Record('Jane', '1111111111')),
+                ('delete', 'John'),
+                ('edit_phone', 'John', '0000000000', '1111111111'),
+            ])
+        self.assertEqual(str(self.john),
+                         'Contact name: John; phones: 1234567890, 5555555555.')
+        self.assertIs(self.book.find('John'), self.john)
+        self.assertIsNone(self.book.find('Jane'))
+        self.assertEqual(self.book.feed.seq, seq)
+
+    def test_batch_not_applied_when_body_raises(self):
+        with self.assertRaises(RuntimeError):
+            with self.book.batch() as ops:
+                ops.append(('add_phone', 'John', '7777777777'))
+                ops.append(('delete', 'John'))
+                raise RuntimeError
+        self.assertIs(self.book.find('John'), self.john)
+        self.assertIsNone(self.john.find_phone('7777777777'))
+
+    def test_delete_then_edit_raises(self):
+        with self.assertRaises(ValueError):
+            self.book.apply_changes([
+                ('delete', 'John'),
+                ('add_phone', 'John', '7777777777'),
+            ])
+        self.assertIs(self.book.find('John'), self.john)
+        self.assertEqual(len(self.john.phones), 2)
+
+    def test_replica_replays_batch(self):
+        log = self.path('feed.log')
+        self.book.ship_log(log)
+        self.addCleanup(self.book.stop_shipping)
+        replica = main.Replica(log)
+        replica.poll()
+        with self.book.batch() as ops:
+            ops.append(('add_record', main.Record('Jane', '1111111111')))
+            ops.append(('add_phone', 'Jane', '2222222222'))
+            ops.append(('edit_phone', 'John', '1234567890', '4444444444'))
+            ops.append(('delete', 'John'))
+        self.assertEqual(replica.poll(), 1)
+        self.assertEqual(replica.seq, self.book.feed.seq)
+        self.assertEqual([str(r) for r in replica.book.data.values()],
+                         [str(r) for r in self.book.data.values()])
+
+
+class TestSnapshot(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.file = self.path('data.bin')
+        self.items = [(f'Name{i}', main.Record(f'Name{i}', f'{i:010d}'))
+                      for i in range(25)]
+
+    def assertItems(self, items):
+        self.assertEqual([(name, str(r)) for name, r in items],
+                         [(name, str(r)) for name, r in self.items])
+
+    def test_round_trip(self):
+        for codec in ('zlib', 'lzma'):
+            with self.subTest(codec=codec):
+                main.Snapshot(self.file, chunk_size=10, codec=codec) \
+                    .save(self.items)
+                data = main.Snapshot(self.file).load()
+                self.assertItems(data.items())
+        self.assertFalse(os.path.exists(self.file + '.tmp'))
+
+    def test_streaming(self):
+        main.Snapshot(self.file, chunk_size=10).save(self.items)
+        self.assertItems(main.Snapshot(self.file))
+
+    def test_corrupt_chunk_raises(self):
+        main.Snapshot(self.file, chunk_size=10).save(self.items)
+        with open(self.file, 'r+b') as fd:
+            fd.seek(-5, os.SEEK_END)
+            fd.write(b'\x00\x00\x00\x00\x00')
+        with self.assertRaises(main.SnapshotError):
+            main.Snapshot(self.file).load()
+        book = main.AddressBook()
+        book.path = self.file
+        with self.assertRaises(main.SnapshotError):
+            book._load_data()
+
+    def test_truncated_raises(self):
+        main.Snapshot(self.file, chunk_size=10).save(self.items)
+        with open(self.file, 'r+b') as fd:
+            fd.truncate(os.path.getsize(self.file) - 1)
+        with self.assertRaises(main.SnapshotError):
+            list(main.Snapshot(self.file))
+
+    def test_legacy_pickle(self):
+        with open(self.file, 'wb') as fd:
+            pickle.dump(dict(self.items), fd)
+        self.assertItems(main.Snapshot(self.file).load().items())
+        self.assertItems(main.Snapshot(self.file))
+
+    def test_empty_and_missing_file(self):
+        open(self.file, 'wb').close()
+        self.assertEqual(main.Snapshot(self.file).load(), {})
+        book = main.AddressBook()
+        book.path = self.path('missing.bin')
+        book._load_data()
+        self.assertEqual(len(book), 0)
+
+    def test_chunk_size_must_be_positive(self):
+        main.Snapshot(self.file).save(self.items)
+        for chunk_size in (0, -1):
+            with self.assertRaises(ValueError):
+                main.Snapshot(self.file, chunk_size=chunk_size)
+        self.assertItems(main.Snapshot(self.file).load().items())
+
+    def test_failed_save_keeps_old_file(self):
+        main.Snapshot(self.file).save(self.items)
+        with self.assertRaises(Exception):
+            main.Snapshot(self.file).save([('bad', lambda: None)])
+        self.assertFalse(os.path.exists(self.file + '.tmp'))
+        self.assertItems(main.Snapshot(self.file).load().items())
+
+
+class TestMemoryBudget(TempDirTestCase):
+    def setUp(self):
+        super().setUp()
+        self.book = main.AddressBook(memory_budget=5000)
+        for i in range(50):
+            self.book.add_record(main.Record(f'Name{i}', f'{i:010d}'))
+
+    def cold(self):
+        return [name for name, record in self.book.data.entries.items()
+                if isinstance(record, bytes)]
+
+    def test_evict_and_rehydrate(self):
+        store = self.book.data
+        self.assertLessEqual(store.hot_size, store.budget)
+        self.assertIn('Name0', self.cold())
+        record = self.book.find('Name0')
+        self.assertEqual(str(record),
+                         'Contact name: Name0; phones: 0000000000.')
+        self.assertNotIn('Name0', self.cold())
+        self.assertIs(record._feed, store)
+        self.assertEqual(len(self.book.iterator(7).__next__()), 7)
+        self.assertEqual(len(self.book.find_mathes('Name')), 50)
+
+    def test_scan_keeps_clean_bytes(self):
+        before = dict(self.book.data.entries)
+        self.book.find_mathes('Name')
+        for name, raw in self.book.data.entries.items():
+            if isinstance(raw, bytes) and isinstance(before[name], bytes):
+                self.assertIs(raw, before[name])
+
+    def test_grown_records_are_measured(self):
+        store = self.book.data
+        for i in range(40, 50):
+            record = self.book.find(f'Name{i}')
+            for j in range(200):
+                record.add_phone(f'{j:010d}')
+        actual = sum(sum(store.footprint(store.entries[name]).values())
+                     for name in store.lru if name not in store.clean)
+        self.assertEqual(store.hot_size, actual + sum(
+            store.lru[name] for name in store.lru if name in store.clean))
+        # only the most recently used record may exceed the budget alone
+        self.assertLessEqual(store.hot_size,
+                             max(store.budget, store.lru['Name49']))
+        self.assertIn('Name40', self.cold())
+        self.assertEqual(len(self.book.find('Name40').phones), 200)
+
+    def test_held_reference_edits_are_kept(self):
+        record = self.book.find('Name0')
+        for i in range(1, 50):
+            self.book.find(f'Name{i}')
+        self.assertIn('Name0', self.cold())
+        record.add_phone('5555555555')
+        self.assertIs(self.book.find('Name0'), record)
+        for i in range(1, 50):
+            self.book.find(f'Name{i}')
+        del record
+        self.assertIsNotNone(self.book.find('Name0').find_phone('5555555555'))
+
+    def test_batch_rollback_with_eviction(self):
+        ops = [('edit_phone', f'Name{i}', f'{i:010d}', '9999999999')
+               for i in range(50)]
+        ops.append(('edit_phone', 'Name0', '0000000000', '1111111111'))
+        with self.assertRaises(ValueError):
+            self.book.apply_changes(ops)
+        self.assertEqual([str(p) for p in self.book.find('Name0').phones],
+                         ['0000000000'])
+
+    def test_save_and_load(self):
+        self.book.path = self.path('data.bin')
+        self.book._save_data()
+        plain = main.AddressBook()
+        plain.path = self.book.path
+        plain._load_data()
+        self.assertEqual(len(plain), 50)
+        self.assertEqual(str(plain.find('Name0')),
+                         'Contact name: Name0; phones: 0000000000.')
+        budget = main.AddressBook(memory_budget=5000)
+        budget.path = self.book.path
+        budget._load_data()
+        self.assertEqual(len(budget.data), 50)
+        self.assertEqual(str(budget.find('Name0')), str(plain.find('Name0')))
+
+    def test_memory_report(self):
+        report = self.book.memory_report()
+        self.assertEqual(set(report),
+                         {'records', 'fields', 'phones', 'cold', 'index',
+                          'feed', 'total', 'contacts', 'per_contact',
+                          'formatted', 'load_peak'})
+        self.assertGreater(report['cold'], 0)
+        self.assertEqual(report['total'], sum(
+            report[key] for key in ('records', 'fields', 'phones', 'cold',
+                                    'index', 'feed')))
+        self.assertEqual(report['contacts'], 50)
+        self.assertEqual(report['per_contact'], report['total'] // 50)
+
+    def test_load_peak_and_tracing_stopped_on_error(self):
+        self.book.path = self.path('data.bin')
+        self.book._save_data()
+        book = main.AddressBook()
+        book.path = self.book.path
+        book.trace_memory = True
+        book._load_data()
+        self.assertGreater(book.memory_report()['load_peak'], 0)
+        self.assertFalse(tracemalloc.is_tracing())
+        with open(book.path, 'r+b') as fd:
+            fd.seek(-5, os.SEEK_END)
+            fd.write(b'\x00\x00\x00\x00\x00')
+        with self.assertRaises(main.SnapshotError):
+            book._load_data()
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+if __name__ == '__main__':
+    unittest.main()